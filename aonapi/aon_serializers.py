@@ -1,53 +1,105 @@
-# These are functions that interpret raw aon data and create model instances from it. They are used in the route handlers to fetch and store data from the aon api.
-from aonapi.models import Ancestry, Class, DefaultNethysDataModel
+# These are functions that interpret raw aon data and build table rows from it. They are used in the route handlers to fetch and store data from the aon api.
+# Rows are plain dicts keyed by column name so they can be bulk inserted without constructing a model instance per record.
+# Callers serializing a batch should pass a shared `now` so every row gets the same last_fetched timestamp.
 from aonapi import enums
 from datetime import datetime
+from difflib import get_close_matches
+from functools import lru_cache
 from logging import getLogger
+import re
+
+logger = getLogger(__name__)
+
+# Matches the name inside each markdown link, e.g. "[Common](/Languages.aspx?ID=1)" -> "Common".
+LANGUAGE_PATTERN = re.compile(r"\[([^\]]+)\]")
 
 
 def parse_aon_languages(raw_language: str) -> list[str]:
     """Parses AoN language data into a list of strings."""
-    languages = raw_language.split(", ")
-    parsed_languages = [lang.split("]")[0].strip("[").strip() for lang in languages]
-    return parsed_languages
+    return [lang.strip() for lang in LANGUAGE_PATTERN.findall(raw_language)]
 
 
-def parse_ability_mispellings(ability: str) -> enums.Ability | enums.AbilityBoost:
-    """Some AoN data has mispelled ability names. This function corrects them."""
-    if ability is None:
-        return None
+# Some AoN data has mispelled ability names. These map the known misspellings to the correct ability.
+ABILITY_MISSPELLINGS = {
+    "intelligence": {"inteligence", "intellgence", "intellignce", "intellignece"},
+    "strength": {"strengh", "strenght"},
+    "dexterity": {"dextarity", "dextarity", "dexteirty"},
+    "constitution": {"constition", "consitution"},
+    "wisdom": {"widsom"},
+    "charisma": {"charimsa"},
+}
 
-    if ability.replace(" ", "_") in enums.AbilityBoost.__members__:
-        return getattr(enums.AbilityBoost, ability.replace(" ", "_"))
+# Special cases that map to an ability boost rather than an ability.
+ABILITY_BOOST_SPECIAL_CASES = {
+    "two free ability boosts": {"two_free", "two free", "2 free"},
+    "free": {"free"},
+}
+
+# Flattened lookup table built once at import, so each parse is a single dict lookup.
+_ABILITY_LOOKUP: dict[str, enums.Ability | enums.AbilityBoost] = {
+    **{
+        misspelling: getattr(enums.AbilityBoost, correct_spelling.replace(" ", "_"))
+        for correct_spelling, misspellings in ABILITY_BOOST_SPECIAL_CASES.items()
+        for misspelling in misspellings
+    },
+    **{
+        misspelling: getattr(enums.Ability, correct_spelling)
+        for correct_spelling, misspellings in ABILITY_MISSPELLINGS.items()
+        for misspelling in misspellings
+    },
+    # Exact member names take priority over everything else.
+    **enums.AbilityBoost.__members__,
+}
 
-    ability_map = {
-        "intelligence": {"inteligence", "intellgence", "intellignce", "intellignece"},
-        "strength": {"strengh", "strenght"},
-        "dexterity": {"dextarity", "dextarity", "dexteirty"},
-        "constitution": {"constition", "consitution"},
-        "wisdom": {"widsom"},
-        "charisma": {"charimsa"},
-    }
 
-    for correct_spelling, misspellings in ability_map.items():
-        if ability in misspellings:
-            return getattr(enums.Ability, correct_spelling)
+# Misspellings that aren't listed above are matched against these by similarity.
+_ABILITY_NAMES = [ability.value for ability in enums.Ability]
 
-    # Handle special cases explicitly
-    special_cases = {
-        "two free ability boosts": {"two_free", "two free", "2 free"},
-        "free": {"free"},
-    }
 
-    for correct_spelling, misspellings in special_cases.items():
-        if ability in misspellings:
-            return getattr(enums.AbilityBoost, correct_spelling.replace(" ", "_"))
+@lru_cache(maxsize=256)
+def _closest_ability(ability: str) -> enums.Ability | None:
+    """Returns the ability whose name is closest to the given misspelling, if any is close enough."""
+    matches = get_close_matches(ability, _ABILITY_NAMES, n=1, cutoff=0.8)
+    if not matches:
+        return None
 
-    raise ValueError(f"Unknown ability: {ability}")
+    logger.warning(
+        "Corrected unknown ability %r to %r, consider adding it to ABILITY_MISSPELLINGS.",
+        ability,
+        matches[0],
+    )
+    return enums.Ability(matches[0])
 
 
-def parse_ancestry_data(aon_data: dict, uuid_group_id: int) -> Ancestry:
-    """Parses AoN data into an Ancestry model instance."""
+def parse_ability_mispellings(ability: str) -> enums.Ability | enums.AbilityBoost:
+    """Some AoN data has mispelled ability names. This function corrects them."""
+    if ability is None:
+        return None
+
+    parsed = _ABILITY_LOOKUP.get(ability.replace(" ", "_"))
+    if parsed is None:
+        parsed = _ABILITY_LOOKUP.get(ability)
+    if parsed is None:
+        parsed = _closest_ability(ability)
+    if parsed is None:
+        raise ValueError(f"Unknown ability: {ability}")
+    return parsed
+
+
+# Lookup tables from lowercase AoN values to enum members, so parsing is a single dict lookup per value.
+_SIZE_BY_LOWER = {size.value: size for size in enums.Size}
+_RARITY_BY_LOWER = {rarity.value: rarity for rarity in enums.Rarity}
+_VISION_BY_LOWER = {vision.value: vision for vision in enums.Vision}
+_ABILITY_BY_LOWER = {ability.value: ability for ability in enums.Ability}
+_TRADITION_BY_LOWER = {
+    tradition.value: tradition for tradition in enums.SpellcastingTradition
+}
+
+
+def parse_ancestry_data(
+    aon_data: dict, uuid_group_id: int, now: datetime | None = None
+) -> dict:
+    """Parses AoN data into a row for the Ancestry table."""
     aon_hp = aon_data.get("hp_raw")
     cast_hp = int(aon_hp) if aon_hp else None
 
@@ -55,42 +107,62 @@ def parse_ancestry_data(aon_data: dict, uuid_group_id: int) -> Ancestry:
     cast_speed = aon_speed.get("max") if aon_speed else 0
 
     aon_ability_flaw = aon_data.get("attribute_flaw", [None])[0]
-    if type(aon_ability_flaw) == str:
+    if isinstance(aon_ability_flaw, str):
         cast_ability_flaw = aon_ability_flaw.lower()
     else:
         cast_ability_flaw = None
 
-    return Ancestry(
-        id=int(aon_data["id"].split("-")[1]),  # Extract numeric ID
+    aon_vision = aon_data.get("vision")
+    cast_vision = _VISION_BY_LOWER[aon_vision.lower()] if aon_vision else None
+
+    return dict(
+        id=int(aon_data["id"].split("-", 1)[1]),  # Extract numeric ID
         uuid_group_id=uuid_group_id,
-        last_fetched=datetime.now(),
+        last_fetched=now or datetime.now(),
         name=aon_data["name"],
         hp=cast_hp,
-        size=[enums.Size(size.lower()) for size in aon_data.get("size", [])],
+        size_mask=enums.pack_enum_set(
+            (_SIZE_BY_LOWER[size.lower()] for size in aon_data.get("size", [])),
+            enums.Size,
+        ),
         speed=cast_speed,
-        ability_boost=list(
-            map(
-                lambda x: parse_ability_mispellings(x),
-                map(lambda x: x.lower(), aon_data.get("attribute", [])),
-            )
+        ability_boost_mask=enums.pack_enum_set(
+            (
+                parse_ability_mispellings(ability.lower())
+                for ability in aon_data.get("attribute", [])
+            ),
+            enums.AbilityBoost,
         ),
         ability_flaw=parse_ability_mispellings(cast_ability_flaw),
         language=parse_aon_languages(aon_data.get("language_markdown", "")),
-        vision=aon_data.get("vision", None).lower() if aon_data.get("vision") else None,
-        rarity=aon_data.get("rarity").lower(),
+        vision=cast_vision,
+        rarity=_RARITY_BY_LOWER[aon_data["rarity"].lower()],
     )
 
 
-def parse_class_data(aon_data: dict, uuid_group_id: int) -> Class:
-    """Parses AoN data into a Class model instance."""
-    return Class(
-        id=int(aon_data["id"].split("-")[1]),
+def parse_class_data(
+    aon_data: dict, uuid_group_id: int, now: datetime | None = None
+) -> dict:
+    """Parses AoN data into a row for the Class table."""
+    aon_tradition = aon_data.get("tradition")
+    cast_tradition = (
+        _TRADITION_BY_LOWER[aon_tradition.lower()] if aon_tradition else None
+    )
+
+    return dict(
+        id=int(aon_data["id"].split("-", 1)[1]),
         uuid_group_id=uuid_group_id,
-        last_fetched=datetime.now(),
+        last_fetched=now or datetime.now(),
         name=aon_data["name"],
-        ability=aon_data.get("ability", []),
+        ability_mask=enums.pack_enum_set(
+            (
+                _ABILITY_BY_LOWER[ability.lower()]
+                for ability in aon_data.get("ability", [])
+            ),
+            enums.Ability,
+        ),
         hp=aon_data.get("hp", 0),
-        tradition=aon_data.get("tradition"),
+        tradition=cast_tradition,
         attack_proficiency=aon_data.get("attack_proficiency", {}),
         defense_proficiency=aon_data.get("defense_proficiency", {}),
         fortitude_save_proficiency=aon_data.get("fortitude_save_proficiency"),
@@ -98,20 +170,20 @@ def parse_class_data(aon_data: dict, uuid_group_id: int) -> Class:
         will_save_proficiency=aon_data.get("will_save_proficiency"),
         perception_proficiency=aon_data.get("perception_proficiency"),
         skill_proficiency=aon_data.get("skill_proficiency", {}),
-        rarity=aon_data.get("rarity"),
+        rarity=_RARITY_BY_LOWER[aon_data["rarity"].lower()],
     )
 
 
 def default_nethys_data_serializer(
-    aon_data: dict, uuid_group_id: int
-) -> DefaultNethysDataModel:
-    """Default serializer for Nethys data."""
-    return DefaultNethysDataModel(
+    aon_data: dict, uuid_group_id: int, now: datetime | None = None
+) -> dict:
+    """Default serializer for Nethys data, builds a row for the DefaultNethysDataModel table."""
+    return dict(
         category_id=aon_data["id"],
         category_name=aon_data["category"],
         data=aon_data,
         uuid_group_id=uuid_group_id,
-        last_fetched=datetime.now(),
+        last_fetched=now or datetime.now(),
     )
 
 
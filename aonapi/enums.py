@@ -1,4 +1,6 @@
 from enum import Enum
+from functools import cache
+from typing import Iterable
 
 
 class Size(str, Enum):
@@ -143,3 +145,27 @@ class Lore(str, Enum):
     theater = "theater"
     underworld = "underworld"
     warfare = "warfare"
+
+
+@cache
+def _enum_bits(enum_cls: type[Enum]) -> dict[Enum, int]:
+    """Maps each member of an enum to its bit, in definition order. Built once per enum."""
+    return {member: 1 << bit for bit, member in enumerate(enum_cls)}
+
+
+def pack_enum_set(values: Iterable[Enum], enum_cls: type[Enum]) -> int:
+    """Packs a collection of enum values into an int bitmask, with one bit per member in definition order."""
+    bits = _enum_bits(enum_cls)
+    mask = 0
+    for value in values:
+        # Values are usually already members, only convert the ones that aren't (e.g. an Ability packed as an AbilityBoost)
+        bit = bits.get(value)
+        if bit is None:
+            bit = bits[enum_cls(value)]
+        mask |= bit
+    return mask
+
+
+def unpack_enum_set(mask: int, enum_cls: type[Enum]) -> list[Enum]:
+    """Unpacks an int bitmask created by pack_enum_set back into a list of enum members."""
+    return [member for bit, member in enumerate(enum_cls) if mask >> bit & 1]
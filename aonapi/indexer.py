@@ -1,13 +1,17 @@
+import orjson
 import requests
-import time
+from requests.adapters import HTTPAdapter
 import logging
-from typing import Dict, List
-from aonapi.settings import index_path
+import sys
+import threading
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Set
+from aonapi.settings import index_path, user_agent
 from aonapi.utils import SingletonMeta
 from aonapi.models import Category, UUID_Group, engine
+from aonapi.routes.nethys_data import invalidate_listing_caches
 from sqlmodel import Session, select
-from cachetools import TTLCache
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 logger = logging.getLogger(__name__)
 
@@ -18,11 +22,39 @@ class UUIDIndexCache(metaclass=SingletonMeta):
     def __init__(self):
         self._cache_duration = 3600  # 1 hour cache duration
 
+        # Reuse one keep-alive connection for every refresh instead of a new TCP/TLS handshake each time.
+        self._session = requests.Session()
+        self._session.headers.update(
+            {
+                "Accept-Encoding": "gzip, deflate",
+                "Accept": "application/json",
+                "User-Agent": user_agent,
+            }
+        )
+        self._session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=4))
+
+        # Validators from the last successful fetch, used to skip re-downloading an unchanged index.
+        self._last_index = None
+        self._conditional_headers = {}
+
     def _refresh_cache(self) -> Dict[str, List[str]]:
-        response = requests.get(index_path)
+        response = self._session.get(
+            index_path, headers=self._conditional_headers, timeout=10
+        )
+        if response.status_code == 304:
+            return self._last_index
         if response.status_code != 200:
             raise Exception(f"Failed to get UUIDs. Status code: {response.status_code}")
-        return response.json()
+        # The index is a large dict of short string lists, orjson decodes it much faster than the stdlib parser.
+        self._last_index = orjson.loads(response.content)
+        self._conditional_headers = {}
+        if "ETag" in response.headers:
+            self._conditional_headers["If-None-Match"] = response.headers["ETag"]
+        if "Last-Modified" in response.headers:
+            self._conditional_headers["If-Modified-Since"] = response.headers[
+                "Last-Modified"
+            ]
+        return self._last_index
 
     def get_uuid_index(self) -> Dict[str, List[str]]:
         return SingletonMeta.get_cached_value(self, self._refresh_cache)
@@ -41,77 +73,113 @@ def invalidate_uuid_index_cache():
     cache.invalidate_cache()
 
 
-category_cache = TTLCache(maxsize=100, ttl=300)  # 5-minute cache
+# Categories are tiny and append-only, so they're kept in a plain dict loaded once and extended as new ones are created.
+# The lock is only taken when the dict needs to change.
+_categories: Dict[str, int] = {}
+_categories_lock = threading.Lock()
 
 
-def fetch_categories():
-    """Fetch categories from DB, using cache if available."""
-    if "categories" in category_cache:
-        return category_cache["categories"]
+def _load_categories(session: Session):
+    """Loads the category mappings from the DB into memory."""
+    # Only the two columns are selected, so no Category instances are built during a refresh.
+    _categories.update(session.exec(select(Category.name, Category.id)).all())
 
-    with Session(engine) as session:
-        categories = session.exec(select(Category)).all()
-        category_mappings = {category.name: category.id for category in categories}
 
-    category_cache["categories"] = category_mappings
-    return category_mappings
+def fetch_categories() -> Dict[str, int]:
+    """Fetch categories from DB on first use, then serve them from memory."""
+    if not _categories:
+        with _categories_lock, Session(engine) as session:
+            if not _categories:
+                _load_categories(session)
+    return _categories
+
+
+def ensure_categories(names: Set[str]) -> Dict[str, int]:
+    """Ensures all the given categories exist, creating any missing ones in a single insert. Returns the name to ID mappings."""
+    categories = fetch_categories()
+    if names <= categories.keys():
+        return categories
+
+    with _categories_lock, Session(engine) as session:
+        missing = names - categories.keys()
+        if missing:
+            session.execute(
+                sqlite_insert(Category)
+                .values([{"name": name} for name in missing])
+                .on_conflict_do_nothing(index_elements=["name"])
+            )
+            session.commit()
+            _load_categories(session)
+    return categories
 
 
 def get_or_create_category(name: str) -> int:
     """Ensures a category exists, returns its ID."""
-    categories = fetch_categories()
-    if name in categories:
-        return categories[name]
+    return ensure_categories({name})[name]
+
+
+# SQLite limits the number of bound variables per statement, so lookups and inserts are chunked.
+UUID_INSERT_BATCH_SIZE = 500
+
 
+def _batched(iterable: Iterable, size: int) -> Iterator[list]:
+    """Yields lists of up to `size` items from the iterable without materializing the whole thing."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _category_name(items: List[str]) -> str:
+    """Returns the category of a UUID's items, e.g. 'ancestry' for 'ancestry-1234'."""
+    # Category names repeat across thousands of UUIDs, intern them so dict lookups compare by identity.
+    return sys.intern(items[0].split("-", 1)[0])
+
+
+def process_uuids(uuid_data: Dict[str, List[str]]) -> int:
+    """Stores any new UUIDs in the DB using batched bulk inserts. Returns how many were inserted."""
+
+    # Create any new categories up front so building the rows never touches the DB.
+    category_ids = ensure_categories(
+        {_category_name(items) for items in uuid_data.values() if items}
+    )
+
+    # Rows are built lazily, one batch at a time, so memory stays bounded by the batch size.
+    rows = (
+        {"uuid": uuid, "category_id": category_ids[_category_name(items)]}
+        for uuid, items in uuid_data.items()
+        if items
+    )
+
+    inserted = 0
     with Session(engine) as session:
-        new_category = Category(name=name)
-        session.add(new_category)
-        session.commit()
-        session.refresh(new_category)
-
-        category_cache["categories"][name] = new_category.id  # Update cache safely
-        return new_category.id
-
-
-def process_uuids(uuid_data: Dict[str, List[str]]):
-    """Processes UUIDs and stores them in DB with retry logic to handle database locks."""
-
-    retry_delay = 2  # Seconds
-
-    for uuid, items in uuid_data.items():
-        if not items:
-            continue
-
-        category_name = items[0].split("-")[0]
-        category_id = get_or_create_category(category_name)
-
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                with Session(engine) as session:
-                    with session.begin():  # ✅ Atomic transaction
-                        existing = session.exec(
-                            select(UUID_Group).where(UUID_Group.uuid == uuid)
-                        ).first()
-                        if not existing:
-                            session.add(UUID_Group(uuid=uuid, category_id=category_id))
-                        session.commit()  # Save changes
-                        break  # ✅ Success, exit loop
-            except OperationalError as e:
-                logger.warning(
-                    f"⚠️ Database locked (attempt {attempt+1}/{max_retries}). Retrying in {retry_delay}s..."
+        with session.begin():  # ✅ One transaction for the whole index
+            for batch in _batched(rows, UUID_INSERT_BATCH_SIZE):
+                # Most UUIDs already exist after the first run, so only insert the ones we haven't seen.
+                existing = set(
+                    session.exec(
+                        select(UUID_Group.uuid).where(
+                            UUID_Group.uuid.in_([row["uuid"] for row in batch])
+                        )
+                    ).all()
+                )
+                new_rows = [row for row in batch if row["uuid"] not in existing]
+                if not new_rows:
+                    continue
+
+                session.execute(
+                    sqlite_insert(UUID_Group)
+                    .values(new_rows)
+                    .on_conflict_do_nothing(index_elements=["uuid"])
                 )
-                time.sleep(retry_delay)
-            except Exception as e:
-                logger.error(f"❌ Unexpected error: {e}")
-                break
-        else:
-            logger.error(f"❌ Ran out of retries for UUID: {uuid}")
+                inserted += len(new_rows)
+    return inserted
 
 
 def update_categories_and_uuids():
     """Updates categories and UUIDs periodically."""
     logger.info("🔄 Updating database with UUIDs and categories...")
     uuid_data = get_uuid_index()
-    process_uuids(uuid_data)
+    if process_uuids(uuid_data):
+        # New UUIDs (and possibly categories) were added, so the cached listings are out of date
+        invalidate_listing_caches()
     logger.info("✅ Database update complete.")
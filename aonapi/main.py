@@ -1,9 +1,12 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import ORJSONResponse
 from fastapi.templating import Jinja2Templates
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
 from contextlib import asynccontextmanager
+import asyncio
 from aonapi.indexer import update_categories_and_uuids
+from aonapi.models import init_db
 from aonapi.settings import setup_logging
 
 setup_logging()
@@ -18,14 +21,15 @@ scheduler = AsyncIOScheduler()
 async def lifespan(app: FastAPI):
     await startup_event()
     yield
-    pass
+    scheduler.shutdown(wait=False)
+    await close_aon_client()
 
 
-# This is the main FastAPI app.
-app = FastAPI(lifespan=lifespan)
+# This is the main FastAPI app. Responses are encoded with orjson rather than the stdlib json module.
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 templates = Jinja2Templates(directory="aonapi/templates")
 
-from aonapi.routes.nethys_data import router as nethys_data_router
+from aonapi.routes.nethys_data import router as nethys_data_router, close_aon_client
 
 app.include_router(nethys_data_router)
 
@@ -38,11 +42,22 @@ async def read_root(request: Request):
     )
 
 
+# The update does blocking HTTP and DB work, so run it in a worker thread to keep the event loop free.
+async def update_categories_and_uuids_async():
+    await asyncio.to_thread(update_categories_and_uuids)
+
+
 # This is the event that will run when the app starts up.
 async def startup_event():
     print("Starting up...")
-    update_categories_and_uuids()  # Initial update
+    init_db()
+    await update_categories_and_uuids_async()  # Initial update
+    # A fixed id means a repeated startup replaces the job instead of scheduling a duplicate.
     scheduler.add_job(
-        update_categories_and_uuids, trigger=IntervalTrigger(seconds=1800)
+        update_categories_and_uuids_async,
+        trigger=IntervalTrigger(seconds=1800),
+        id="update_categories_and_uuids",
+        replace_existing=True,
     )  # Run every 30 minutes
-    scheduler.start()
+    if not scheduler.running:
+        scheduler.start()
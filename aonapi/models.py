@@ -1,8 +1,14 @@
-from sqlmodel import Field, SQLModel, create_engine, PickleType, Column
+from sqlmodel import Field, Relationship, SQLModel, create_engine, JSON, Column
 from typing import List, Dict, Any
+from sqlalchemy import event, inspect
+from pydantic import computed_field
 from aonapi import enums
 from aonapi.settings import database_url
 from datetime import datetime
+import logging
+import orjson
+
+logger = logging.getLogger(__name__)
 
 
 class NethysData(SQLModel):
@@ -12,7 +18,7 @@ class NethysData(SQLModel):
     """
 
     # What uuid_group this item was registered under.
-    uuid_group_id: int | None = Field(foreign_key="uuid_group.id")
+    uuid_group_id: int | None = Field(foreign_key="uuid_group.id", index=True)
     # The time the data was last updated from the aon api.
     last_fetched: datetime
 
@@ -31,6 +37,8 @@ class Category(SQLModel, table=True):
     id: int | None = Field(default=None, primary_key=True)
     name: str = Field(unique=True, index=True)
 
+    uuid_groups: List["UUID_Group"] = Relationship(back_populates="category")
+
 
 class UUID_Group(SQLModel, table=True):
     """
@@ -50,6 +58,8 @@ class UUID_Group(SQLModel, table=True):
     category_id: int = Field(foreign_key="category.id")
     label: str | None
 
+    category: Category = Relationship(back_populates="uuid_groups")
+
 
 class Ancestry(NethysData, table=True):
     """
@@ -63,14 +73,25 @@ class Ancestry(NethysData, table=True):
 
     name: str
     hp: int | None
-    size: List[enums.Size] = Field(sa_column=Column(PickleType))
+    # Sets of closed enums are stored as bitmasks (see enums.pack_enum_set) and exposed as lists below.
+    size_mask: int = Field(default=0)
     speed: int
-    ability_boost: List[enums.AbilityBoost] = Field(sa_column=Column(PickleType))
+    ability_boost_mask: int = Field(default=0)
     ability_flaw: enums.Ability | None
-    language: List[str] = Field(sa_column=Column(PickleType))
+    language: List[str] = Field(sa_column=Column(JSON))
     vision: enums.Vision | None
     rarity: enums.Rarity
 
+    @computed_field
+    @property
+    def size(self) -> List[enums.Size]:
+        return enums.unpack_enum_set(self.size_mask, enums.Size)
+
+    @computed_field
+    @property
+    def ability_boost(self) -> List[enums.AbilityBoost]:
+        return enums.unpack_enum_set(self.ability_boost_mask, enums.AbilityBoost)
+
 
 class Class(NethysData, table=True):
     """
@@ -83,15 +104,16 @@ class Class(NethysData, table=True):
     id: int = Field(primary_key=True)
 
     name: str
-    ability: List[enums.Ability] = Field(sa_column=Column(PickleType))
+    # Stored as a bitmask (see enums.pack_enum_set) and exposed as a list below.
+    ability_mask: int = Field(default=0)
     hp: int
     tradition: enums.SpellcastingTradition | None
 
     attack_proficiency: Dict[enums.AttackProficiency, enums.Proficiency] = Field(
-        sa_column=Column(PickleType)
+        sa_column=Column(JSON)
     )
     defense_proficiency: Dict[enums.DefenseProficiency, enums.Proficiency] = Field(
-        sa_column=Column(PickleType)
+        sa_column=Column(JSON)
     )
 
     fortitude_save_proficiency: enums.Proficiency
@@ -100,11 +122,16 @@ class Class(NethysData, table=True):
 
     perception_proficiency: enums.Proficiency
     skill_proficiency: Dict[enums.Skill | str, enums.Proficiency] = Field(
-        sa_column=Column(PickleType)
+        sa_column=Column(JSON)
     )
 
     rarity: enums.Rarity
 
+    @computed_field
+    @property
+    def ability(self) -> List[enums.Ability]:
+        return enums.unpack_enum_set(self.ability_mask, enums.Ability)
+
 
 class Item(NethysData, table=True):
     """
@@ -121,7 +148,7 @@ class Item(NethysData, table=True):
     id: int = Field(default=None, primary_key=True)
     category_id: str
     category_name: str
-    data: dict[str, Any] = Field(sa_column=Column(PickleType))
+    data: dict[str, Any] = Field(sa_column=Column(JSON))
 
 
 # This dictionary maps category names to their respective models.
@@ -131,5 +158,82 @@ MODEL_MAP = {
 }
 DefaultNethysDataModel = Item
 
-engine = create_engine(database_url)
-SQLModel.metadata.create_all(engine)
+# Tables holding data fetched from AoN. Their rows can always be fetched again, so they are rebuilt when their schema changes.
+NETHYS_DATA_TABLES = [Ancestry.__table__, Class.__table__, Item.__table__]
+
+
+def _json_serializer(value: Any) -> str:
+    """Encodes JSON columns with orjson. Enum dict keys (e.g. proficiencies) are stored by value."""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+engine = create_engine(
+    database_url, json_serializer=_json_serializer, json_deserializer=orjson.loads
+)
+
+
+# SQLite connection settings. WAL lets readers and the refresh writer work concurrently, and
+# synchronous=NORMAL is safe under WAL while syncing far less often than the default.
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",  # 64 MiB
+)
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+if engine.dialect.name == "sqlite":
+    event.listen(engine, "connect", _set_sqlite_pragmas)
+
+
+def _outdated_tables(connection) -> list:
+    """Returns the existing Nethys data tables whose columns don't match their models."""
+    inspector = inspect(connection)
+    dialect = connection.dialect
+    outdated = []
+    for table in NETHYS_DATA_TABLES:
+        if not inspector.has_table(table.name):
+            continue
+        existing_columns = {
+            column["name"]: column["type"].compile(dialect=dialect)
+            for column in inspector.get_columns(table.name)
+        }
+        model_columns = {
+            column.name: column.type.compile(dialect=dialect)
+            for column in table.columns
+        }
+        if existing_columns != model_columns:
+            outdated.append(table)
+    return outdated
+
+
+def drop_outdated_tables():
+    """Drops the Nethys data tables whose schema is out of date, so create_all recreates them."""
+    # Databases created by older versions can have data tables with other column types (e.g. pickled lists) or columns.
+    # The data in them is only a cache of AoN, so they are dropped and recreated empty and refilled on the next fetch.
+    with engine.begin() as connection:
+        outdated = _outdated_tables(connection)
+        if outdated:
+            logger.warning(
+                "Rebuilding outdated data tables: %s",
+                ", ".join(table.name for table in outdated),
+            )
+            SQLModel.metadata.drop_all(connection, tables=outdated)
+
+
+def init_db():
+    """Creates any missing tables and indexes, rebuilding outdated data tables first. Called once when the app starts up."""
+    drop_outdated_tables()
+    SQLModel.metadata.create_all(engine)
+
+    # create_all only creates indexes along with new tables, so add any that existing databases are missing.
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
@@ -1,10 +1,17 @@
 # Routes pertaining to the Nethys data
 from fastapi import Depends, APIRouter
+from fastapi.concurrency import run_in_threadpool
 from sqlmodel import Session, select
+from sqlalchemy import bindparam, func, insert
 
+from cachetools import TTLCache, cached
+from cachetools.keys import hashkey
 from datetime import datetime, timedelta
-import requests
+from itertools import islice
+import httpx
 import logging
+import orjson
+import threading
 
 from aonapi.models import (
     Category,
@@ -14,17 +21,54 @@ from aonapi.models import (
     MODEL_MAP,
 )
 from aonapi import aon_serializers
-from aonapi.utils import get_db
-from aonapi.settings import search_url
+from aonapi.utils import get_db, db_session
+from aonapi.settings import search_url, user_agent
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
+# Base of every AoN document URL, the UUID and ".json" are appended per request
+_aon_url_prefix = search_url + "/"
+
+# Shared async client so AoN fetches reuse pooled keep-alive connections and many can be in flight at once
+# without tying up a threadpool worker each. Closed by close_aon_client when the app shuts down.
+_aon_client = httpx.AsyncClient(
+    headers={"User-Agent": user_agent},
+    timeout=httpx.Timeout(10.0, connect=3.05),
+    transport=httpx.AsyncHTTPTransport(
+        retries=3,
+        limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+    ),
+)
+
+
+async def close_aon_client():
+    """Closes the shared AoN HTTP client."""
+    await _aon_client.aclose()
+
+
+# Categories and UUID groups only change when the index refreshes, so lookups are cached in-process for a few minutes.
+# They're read from the threadpool, so access is guarded by the lock.
+_cache_lock = threading.Lock()
+_categories_cache = TTLCache(maxsize=1, ttl=600)
+_category_uuids_cache = TTLCache(maxsize=1024, ttl=300)
+_uuid_group_cache = TTLCache(maxsize=4096, ttl=300)
+
+# UUIDs that AoN recently returned a 404 for, so repeated requests don't hit AoN again straight away.
+# Only used from fetch_data_from_aon on the event loop, so it doesn't need a lock.
+_aon_miss_cache = TTLCache(maxsize=10_000, ttl=60)
+
+
+def invalidate_listing_caches():
+    """Clears the cached category and UUID listings. Called by the indexer after it adds new categories or UUIDs."""
+    with _cache_lock:
+        _categories_cache.clear()
+        _category_uuids_cache.clear()
+
 
 @router.get("/categories")
+@cached(_categories_cache, key=lambda db: hashkey(), lock=_cache_lock)
 def get_categories(db: Session = Depends(get_db)):
     """
     Returns all available categories.
@@ -34,6 +78,11 @@ def get_categories(db: Session = Depends(get_db)):
 
 
 @router.get("/category/{category_id}/uuids")
+@cached(
+    _category_uuids_cache,
+    key=lambda category_id, db: hashkey(category_id),
+    lock=_cache_lock,
+)
 def get_uuids(category_id: int, db: Session = Depends(get_db)):
     """
     Returns all UUIDs associated with a category.
@@ -47,69 +96,156 @@ def get_uuids(category_id: int, db: Session = Depends(get_db)):
 FETCH_THRESHOLD_SECONDS = (
     7200  # Don't fetch data if it was fetched within the last 2 hours
 )
+FETCH_THRESHOLD = timedelta(seconds=FETCH_THRESHOLD_SECONDS)
+
+# The model and serializer for each category, merged from MODEL_MAP and SERIALIZER_MAP so each fetch needs one lookup
+_DEFAULT_DISPATCH = (
+    DefaultNethysDataModel,
+    aon_serializers.default_nethys_data_serializer,
+)
+_DISPATCH = {
+    name: (
+        MODEL_MAP.get(name, DefaultNethysDataModel),
+        aon_serializers.SERIALIZER_MAP.get(
+            name, aon_serializers.default_nethys_data_serializer
+        ),
+    )
+    for name in MODEL_MAP.keys() | aon_serializers.SERIALIZER_MAP.keys()
+}
 
 
 @router.get("/fetch/{uuid}")
-def get_data_by_uuid(uuid: str, db: Session = Depends(get_db)):
+async def get_data_by_uuid(uuid: str):
     """API endpoint to retrieve data by UUID. Declared route seperately to allow for programmatic access to fetch function."""
-    return fetch_data_by_uuid(uuid, db)
+    return await fetch_data_by_uuid(uuid)
 
 
-def fetch_data_by_uuid(uuid: str, db: Session = Depends(get_db)):
+def run_with_db(func, *args):
+    """Calls func with a new database session as its last argument. Run through run_in_threadpool from async code."""
+    with db_session() as db:
+        return func(*args, db)
+
+
+def get_uuid_group(uuid: str, db: Session) -> tuple[int, str] | None:
     """
-    Fetches data from Archives of Nethys for the given UUID.
-    If the data is already 'cached' in the database (last fetched within the last 2 hours), it returns the existing data.
+    Returns the id and category name of the uuid group for the given UUID, or None if it doesn't exist.
     """
-    # Fetch the uuid group from the database
-    uuid_group = db.exec(select(UUID_Group).where(UUID_Group.uuid == uuid)).first()
+    with _cache_lock:
+        uuid_group = _uuid_group_cache.get(uuid)
+    if uuid_group is not None:
+        return uuid_group
+
+    # Select just the uuid group's id and its category's name in one joined query, without loading either row
+    uuid_group = db.exec(
+        select(UUID_Group.id, Category.name)
+        .join(UUID_Group.category)
+        .where(UUID_Group.uuid == uuid)
+    ).first()
     if not uuid_group:
-        return {"error": "UUID not found."}, 404
+        return None
 
-    # The name of the category for this UUID
-    category_name = (
-        db.exec(select(Category).where(Category.id == uuid_group.category_id))
-        .first()
-        .name
-    )
+    uuid_group = tuple(uuid_group)
+    with _cache_lock:
+        _uuid_group_cache[uuid] = uuid_group
+    return uuid_group
 
-    # The model for this category
-    model = MODEL_MAP.get(category_name, DefaultNethysDataModel)
 
-    # Fetch the data from the database
-    data = db.exec(select(model).where(model.uuid_group_id == uuid_group.id)).all()
+def load_cached_data(uuid: str, db: Session):
+    """
+    Returns the uuid group for the given UUID and its stored data.
+    The uuid group is None if the UUID doesn't exist, and the data is None if it's missing or stale.
+    """
+    # The uuid group and the name of its category
+    uuid_group = get_uuid_group(uuid, db)
+    if not uuid_group:
+        return None, None
+    uuid_group_id, category_name = uuid_group
+    model, _ = _DISPATCH.get(category_name, _DEFAULT_DISPATCH)
+
+    # Check freshness in SQL: the data is only fresh if its oldest entry is. None means there's no data yet.
+    oldest_fetch = db.exec(
+        select(func.min(model.last_fetched)).where(model.uuid_group_id == uuid_group_id)
+    ).one()
+
+    # If the data isn't stale, load and return it
+    threshold = datetime.now() - FETCH_THRESHOLD
+    if oldest_fetch and oldest_fetch > threshold:
+        return (
+            uuid_group,
+            db.exec(select(model).where(model.uuid_group_id == uuid_group_id)).all(),
+        )
+    return uuid_group, None
 
-    # If the data isn't stale, return it
-    now = datetime.now()
-    if data and all(
-        item.last_fetched > now - timedelta(seconds=FETCH_THRESHOLD_SECONDS)
-        for item in data
-    ):
+
+async def fetch_data_by_uuid(uuid: str):
+    """
+    Fetches data from Archives of Nethys for the given UUID.
+    If the data is already 'cached' in the database (last fetched within the last 2 hours), it returns the existing data.
+    """
+    # Only the AoN request runs on the event loop, the blocking database work runs in the threadpool with its own session.
+    uuid_group, data = await run_in_threadpool(run_with_db, load_cached_data, uuid)
+    if not uuid_group:
+        return {"error": "UUID not found."}, 404
+    if data is not None:
         return data
+    uuid_group_id, category_name = uuid_group
+
+    # The model and serializer for this category
+    model, serializer = _DISPATCH.get(category_name, _DEFAULT_DISPATCH)
 
     # If the data is missing or stale, fetch it from the API
-    aon_data = fetch_data_from_aon(uuid)
+    aon_data = await fetch_data_from_aon(uuid)
     if not aon_data:
         return {"error": "Data not found."}, 404
 
     # Parse and store data
-    parsed_data = store_fetched_data(uuid_group, model, category_name, aon_data, db)
-    return parsed_data
+    return await run_in_threadpool(
+        run_with_db,
+        store_fetched_data,
+        uuid_group_id,
+        model,
+        serializer,
+        category_name,
+        aon_data,
+    )
 
 
-def fetch_data_from_aon(uuid: str):
+async def fetch_data_from_aon(uuid: str):
     """
     Fetches data from Archives of Nethys for the given UUID.
     """
-    url = f"{search_url}/{uuid}.json"
-    response = requests.get(url)
+    if uuid in _aon_miss_cache:
+        return None
+
+    response = await _aon_client.get(_aon_url_prefix + uuid + ".json")
     if response.status_code != 200:
+        # Only remember UUIDs AoN doesn't have, other failures (e.g. 5xx or rate limits) may be temporary
+        if response.status_code == 404:
+            _aon_miss_cache[uuid] = True
         return None
-    return response.json()
+    # Parse the raw bytes with orjson rather than decoding to str for the stdlib json parser
+    return orjson.loads(response.content)
+
+
+# Number of serialized rows sent to the database per INSERT statement
+STORE_BATCH_SIZE = 500
+
+
+def count_entries(model: NethysData, uuid_group_id: int, db: Session) -> int:
+    """
+    Counts the entries stored for a uuid group with a SELECT COUNT(*), without loading the rows.
+    """
+    return db.exec(
+        select(func.count())
+        .select_from(model)
+        .where(model.uuid_group_id == uuid_group_id)
+    ).one()
 
 
 def store_fetched_data(
-    uuid_group: UUID_Group,
+    uuid_group_id: int,
     model: NethysData,
+    serializer,
     category_name: str,
     aon_data_list,
     db: Session,
@@ -117,71 +253,91 @@ def store_fetched_data(
     """
     Parses and stores the fetched data in the appropriate table.
     """
-
-    serializer = aon_serializers.SERIALIZER_MAP.get(
-        category_name, aon_serializers.default_nethys_data_serializer
-    )
-
     logger.info(
-        f"Storing data for UUID Group: {uuid_group}, Category: {category_name}, using serializer: {serializer}"
+        "Storing data for UUID Group: %s, Category: %s, using serializer: %s",
+        uuid_group_id,
+        category_name,
+        serializer,
     )
 
-    stored_entries = []
+    created_entries = 0
     failed_entries = 0
 
     # Get the initial count of entries in the database
-    initial_count = (
-        db.exec(select(model).where(model.uuid_group_id == uuid_group.id))
-        .all()
-        .__len__()
-    )
+    initial_count = count_entries(model, uuid_group_id, db)
 
-    for aon_data in aon_data_list:
-        try:
-            new_entry = serializer(aon_data, uuid_group.id)
-            db.add(new_entry)
-            stored_entries.append(new_entry)
-        except Exception as e:
-            failed_entries += 1
-            logger.error(
-                f"Failed to serialize data with ID {aon_data['id'].split('-')[1]}: {e}"
-            )
+    # Every entry in this batch shares one fetch timestamp
+    now = datetime.now()
 
+    def serialized_rows():
+        nonlocal failed_entries
+        for aon_data in aon_data_list:
+            try:
+                yield serializer(aon_data, uuid_group_id, now)
+            except Exception:
+                failed_entries += 1
+                logger.exception(
+                    "Failed to serialize data with ID %s", aon_data.get("id")
+                )
+
+    # Serialize and insert the rows in fixed size batches so only one batch is held in memory at a time
+    rows = serialized_rows()
+    while batch := list(islice(rows, STORE_BATCH_SIZE)):
+        db.execute(insert(model), batch)
+        created_entries += len(batch)
     db.commit()
 
-    # Refresh the entries to get their IDs
-    for entry in stored_entries:
-        db.refresh(entry)
-
     # Get the final count of entries in the database
-    final_count = (
-        db.exec(select(model).where(model.uuid_group_id == uuid_group.id))
-        .all()
-        .__len__()
-    )
+    final_count = count_entries(model, uuid_group_id, db)
 
     logger.info(
-        f"Created {len(stored_entries)} new entries, {failed_entries} entries failed to serialize."
+        "Created %d new entries, %d entries failed to serialize.",
+        created_entries,
+        failed_entries,
     )
     logger.info(
-        f"Initial count of entries: {initial_count}, Final count of entries: {final_count}"
+        "Initial count of entries: %d, Final count of entries: %d",
+        initial_count,
+        final_count,
     )
 
-    # Check for any entries in the database that weren't included in the fresh data
-    fresh_data_ids = {aon_data["id"].split("-")[1] for aon_data in aon_data_list}
-    db_data_ids = {
-        entry.id
-        for entry in db.exec(
-            select(DefaultNethysDataModel).where(
-                DefaultNethysDataModel.uuid_group_id == uuid_group.id
+    # Check for any entries in the database that weren't included in the fresh data.
+    # Category models are keyed by the numeric part of the AoN id, the default model keeps the full AoN id in category_id.
+    if model is DefaultNethysDataModel:
+        id_column = model.category_id
+        fresh_data_ids = {aon_data["id"] for aon_data in aon_data_list}
+    else:
+        id_column = model.id
+        fresh_data_ids = {
+            int(aon_id)
+            for aon_data in aon_data_list
+            if (aon_id := aon_data["id"].split("-", 1)[-1]).isdigit()
+        }
+
+    # The set difference runs in SQL so only the missing ids are loaded. The fresh ids are rendered inline rather than
+    # bound one parameter each, so large groups don't run into SQLite's bound parameter limit.
+    missing_ids = db.exec(
+        select(id_column)
+        .where(model.uuid_group_id == uuid_group_id)
+        .where(
+            id_column.not_in(
+                bindparam(
+                    "fresh_data_ids",
+                    list(fresh_data_ids),
+                    expanding=True,
+                    literal_execute=True,
+                )
             )
-        ).all()
-    }
-
-    missing_ids = db_data_ids - fresh_data_ids
+        )
+    ).all()
     if missing_ids:
         logger.warning(
-            f"Entries in the database not included in the fresh data: {missing_ids}"
+            "Entries in the database not included in the fresh data: %s", missing_ids
         )
 
-    return stored_entries
+    # Return the rows written by this fetch, they're the only ones with this fetch's timestamp or later
+    return db.exec(
+        select(model)
+        .where(model.uuid_group_id == uuid_group_id)
+        .where(model.last_fetched >= now)
+    ).all()
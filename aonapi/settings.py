@@ -13,6 +13,9 @@ elastic_search_prefix = "elasticsearch"
 search_url = f"{aon_protocol}://{elastic_search_prefix}.{aon_base_url}/json-data"
 index_path = f"{search_url}/aon52-index.json"
 
+# Identifies us to Archives of Nethys on outgoing requests
+user_agent = "aonapi/0.1.0"
+
 
 LOGGING_CONFIG = {
     "version": 1,
@@ -1,21 +1,29 @@
 import threading
+import time
+from contextlib import contextmanager
 from sqlmodel import Session
 from aonapi.models import engine
 
 
 def get_db():
     """Dependency to get a new database session."""
-    with Session(engine) as session:
+    # Objects aren't expired on commit so rows returned from a route can be serialized without reloading them.
+    with Session(engine, expire_on_commit=False) as session:
         yield session
 
 
+# get_db as a context manager, for blocking database work that async routes hand off to the threadpool.
+# The session is opened and closed in the worker thread instead of being shared with the event loop.
+db_session = contextmanager(get_db)
+
+
 class SingletonMeta(type):
     """
-    A thread-safe singleton metaclass with cache invalidation and timer functionality.
+    A thread-safe singleton metaclass with cache invalidation and expiry functionality.
 
     This metaclass ensures that only one instance of a class is created (singleton pattern).
-    It also provides cache invalidation and timer functionality to automatically refresh
-    the cached value after a specified duration.
+    It also provides cache invalidation and expiry functionality to automatically refresh
+    the cached value after a specified duration. Expiry is checked lazily when the value is read.
 
     To Use:
         To use this metaclass, set the metaclass attribute of the class to SingletonMeta.
@@ -53,8 +61,7 @@ class SingletonMeta(type):
 
     Methods:
         __call__(cls, *args, **kwargs): Creates or returns the singleton instance of the class.
-        _set_invalidation_timer(instance): Sets a timer to invalidate the cache after the specified duration.
-        invalidate_cache(instance): Invalidates the cache and resets the invalidation timer.
+        invalidate_cache(instance): Invalidates the cache.
         get_cached_value(instance, refresh_method): Retrieves the cached value or refreshes it using the provided method.
     """
 
@@ -66,7 +73,7 @@ class SingletonMeta(type):
         Creates or returns the singleton instance of the class.
 
         This method ensures that only one instance of the class is created.
-        It also initializes cache-related attributes and sets the invalidation timer.
+        It also initializes cache-related attributes.
 
         Args:
             *args: Variable length argument list.
@@ -80,51 +87,31 @@ class SingletonMeta(type):
                 instance = super().__call__(*args, **kwargs)
                 cls._instances[cls] = instance
                 instance._cache = None
-                instance._timer = None
+                instance._cache_expires_at = 0.0
                 instance._cache_duration = getattr(
                     instance, "_cache_duration", 300
                 )  # Default to 300 seconds if not set
-                cls._set_invalidation_timer(instance)
         return cls._instances[cls]
 
-    @staticmethod
-    def _set_invalidation_timer(instance):
-        """
-        Sets a timer to invalidate the cache after the specified duration.
-
-        This method cancels any existing timer and sets a new timer to call
-        the invalidate_cache method after the cache duration.
-
-        Args:
-            instance: The singleton instance of the class.
-        """
-        if instance._timer is not None:
-            instance._timer.cancel()
-        instance._timer = threading.Timer(
-            instance._cache_duration, lambda: instance.invalidate_cache()
-        )
-        instance._timer.start()
-
     @staticmethod
     def invalidate_cache(instance):
         """
-        Invalidates the cache and resets the invalidation timer.
+        Invalidates the cache.
 
-        This method sets the cache to None and resets the invalidation timer.
+        This method sets the cache to None so the next read refreshes it.
 
         Args:
             instance: The singleton instance of the class.
         """
         instance._cache = None
-        SingletonMeta._set_invalidation_timer(instance)
 
     @staticmethod
     def get_cached_value(instance, refresh_method):
         """
         Retrieves the cached value or refreshes it using the provided method.
 
-        This method checks if the cache is None and, if so, calls the refresh_method
-        to refresh the cache. It also sets the invalidation timer.
+        This method checks if the cache is None or has expired and, if so, calls the
+        refresh_method to refresh the cache and sets its new expiry time.
 
         Args:
             instance: The singleton instance of the class.
@@ -133,7 +120,7 @@ class SingletonMeta(type):
         Returns:
             The cached value.
         """
-        if instance._cache is None:
+        if instance._cache is None or time.monotonic() >= instance._cache_expires_at:
             instance._cache = refresh_method()
-            SingletonMeta._set_invalidation_timer(instance)
+            instance._cache_expires_at = time.monotonic() + instance._cache_duration
         return instance._cache